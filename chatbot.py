@@ -1,16 +1,20 @@
 import streamlit as st
 import anthropic
+import asyncio
 import time
-from typing import Dict, List, Optional
-import json
+import io
+import re
+from typing import Dict, List, Optional, TextIO
+import orjson
+import sqlite3
+import threading
+import uuid
+import weakref
+from history import select_relevant_history, term_vector
 
 # Initialize session state
-if 'messages' not in st.session_state:
-    st.session_state.messages = []
 if 'current_tokens' not in st.session_state:
     st.session_state.current_tokens = 0
-if 'total_cost' not in st.session_state:
-    st.session_state.total_cost = 0.0
 
 CLAUDE_MODEL = "claude-3-5-sonnet-20241022"
 INITIAL_SYSTEM_MESSAGE = """You are an educational assistant focused on helping users build chatbots. 
@@ -18,93 +22,266 @@ You provide clear, detailed explanations and adapt your teaching style to the us
 Break down complex concepts into manageable parts and provide practical examples when helpful.
 When explaining technical concepts, provide context and build understanding incrementally."""
 
-COST_PER_1K_INPUT_TOKENS = 0.015
-COST_PER_1K_OUTPUT_TOKENS = 0.075
+MICRO_USD_PER_INPUT_TOKEN = 15
+MICRO_USD_PER_OUTPUT_TOKEN = 75
+CACHE_WRITE_RATE_PERCENT = 125
+CACHE_READ_RATE_PERCENT = 10
+USAGE_CAPTION = "Tokens used - Input: %d, Output: %d, Cost: $%.4f"
+STREAM_STALL_TIMEOUT = 30.0
+STREAM_REDRAW_INTERVAL = 0.1
+MARKDOWN_PATTERN = re.compile(
+    r'[`*#\[_|]|^\s*(?:[-+>]|\d+[.)])\s|^\s*-{3,}\s*$',
+    re.MULTILINE
+)
+API_ERROR_PATTERN = re.compile(
+    r'(?P<rate_limit>rate_limit)|(?P<invalid_request>invalid_request)|'
+    r'(?P<authentication>authentication)|(?P<model>model)',
+    re.IGNORECASE
+)
+CONVERSATION_DB = "conversations.db"
+
+class ConvStore:
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "session_id TEXT NOT NULL, idx INTEGER NOT NULL, role TEXT NOT NULL, "
+            "content TEXT NOT NULL, cost_micro INTEGER, PRIMARY KEY (session_id, idx))"
+        )
+
+    def append(self, session_id: str, rows: List[tuple]):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for role, content, cost_micro in rows:
+                    self._conn.execute(
+                        "INSERT INTO messages (session_id, idx, role, content, cost_micro) "
+                        "SELECT ?, COALESCE(MAX(idx), -1) + 1, ?, ?, ? FROM messages WHERE session_id = ?",
+                        (session_id, role, content, cost_micro, session_id)
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def load(self, session_id: str) -> List[tuple]:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT role, content, cost_micro FROM messages WHERE session_id = ? ORDER BY idx",
+                (session_id,)
+            ).fetchall()
+
+@st.cache_resource(show_spinner=False)
+def get_store() -> ConvStore:
+    return ConvStore(CONVERSATION_DB)
+
+def get_session_id() -> str:
+    if 'session' not in st.query_params:
+        st.query_params['session'] = uuid.uuid4().hex
+    return st.query_params['session']
+
+def add_to_session(role: str, content: str, cost_micro: Optional[int]) -> Dict:
+    message = {"role": role, "content": content}
+    if cost_micro is not None:
+        message["cost"] = cost_micro / 1e6
+        st.session_state.total_cost_micro += cost_micro
+    st.session_state.messages.append(message)
+    st.session_state.api_messages.append({"role": role, "content": content})
+    st.session_state.term_vectors.append(term_vector(content))
+    return message
+
+def load_conversation():
+    if 'messages' in st.session_state:
+        return
+    st.session_state.messages = []
+    st.session_state.api_messages = []
+    st.session_state.term_vectors = []
+    st.session_state.total_cost_micro = 0
+    for role, content, cost_micro in get_store().load(get_session_id()):
+        add_to_session(role, content, cost_micro)
+
+def append_exchange(prompt: str, response_text: str, cost_micro: int) -> Dict:
+    get_store().append(get_session_id(), [
+        ("user", prompt, None),
+        ("assistant", response_text, cost_micro)
+    ])
+    add_to_session("user", prompt, None)
+    return add_to_session("assistant", response_text, cost_micro)
+
+def close_session_client(loop: asyncio.AbstractEventLoop, client: anthropic.AsyncAnthropic):
+    if not loop.is_closed():
+        loop.run_until_complete(client.close())
+        loop.close()
+
+class SessionClient:
+    def __init__(self, api_key: str):
+        self.api_key = api_key
+        self.loop = asyncio.new_event_loop()
+        self.client = anthropic.AsyncAnthropic(api_key=api_key)
+        self._finalizer = weakref.finalize(self, close_session_client, self.loop, self.client)
+
+    def run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def close(self):
+        self._finalizer()
+
+def get_session_client(api_key: str) -> SessionClient:
+    session_client = st.session_state.get('session_client')
+    if session_client is None or session_client.api_key != api_key:
+        if session_client is not None:
+            session_client.close()
+        session_client = SessionClient(api_key)
+        st.session_state.session_client = session_client
+    return session_client
 
 def validate_api_key(api_key: str) -> bool:
+    if api_key == st.session_state.get('validated_key'):
+        return True
     try:
-        client = anthropic.Client(api_key=api_key)
-        client.messages.create(
-            model=CLAUDE_MODEL,
-            max_tokens=1,
-            messages=[{"role": "user", "content": "test"}]
-        )
+        session_client = get_session_client(api_key)
+        session_client.run(session_client.client.models.retrieve(CLAUDE_MODEL, timeout=10.0))
+        st.session_state.validated_key = api_key
         return True
     except Exception:
         return False
 
-def calculate_cost(num_input_tokens: int, num_output_tokens: int) -> float:
-    input_cost = (num_input_tokens / 1000) * COST_PER_1K_INPUT_TOKENS
-    output_cost = (num_output_tokens / 1000) * COST_PER_1K_OUTPUT_TOKENS
-    return input_cost + output_cost
+def calculate_cost_micro(num_input_tokens: int, num_output_tokens: int, num_cache_write_tokens: int = 0, num_cache_read_tokens: int = 0) -> int:
+    input_percent = (
+        num_input_tokens * 100
+        + num_cache_write_tokens * CACHE_WRITE_RATE_PERCENT
+        + num_cache_read_tokens * CACHE_READ_RATE_PERCENT
+    )
+    centi_micro = input_percent * MICRO_USD_PER_INPUT_TOKEN + num_output_tokens * 100 * MICRO_USD_PER_OUTPUT_TOKEN
+    return (centi_micro + 50) // 100
+
+def total_input_tokens(usage_stats: Dict) -> int:
+    return (
+        usage_stats['input_tokens']
+        + usage_stats['cache_creation_input_tokens']
+        + usage_stats['cache_read_input_tokens']
+    )
+
+def total_cost() -> float:
+    return st.session_state.total_cost_micro / 1e6
 
 def handle_api_error(error: Exception) -> str:
     error_str = str(error)
-    if "rate_limit" in error_str.lower():
+    found = {m.lastgroup for m in API_ERROR_PATTERN.finditer(error_str)}
+    if "rate_limit" in found:
         return "Rate limit exceeded. Please wait a moment before trying again."
-    elif "invalid_request" in error_str.lower():
-        if "model" in error_str.lower():
+    elif "invalid_request" in found:
+        if "model" in found:
             return "Please check your API access permissions for Claude 3.5 Sonnet."
         return "Please check your input and try again."
-    elif "authentication" in error_str.lower():
+    elif "authentication" in found:
         return "Authentication failed. Please verify your API key."
     else:
         return f"An unexpected error occurred: {error_str}"
 
-def get_safe_response(client: anthropic.Client, messages: List[Dict], max_tokens: int, temperature: float) -> tuple[Optional[str], Optional[Dict], Optional[str]]:
+def with_cache_breakpoint(messages: List[Dict]) -> List[Dict]:
+    if not messages:
+        return messages
+    last = messages[-1]
+    tagged = {
+        "role": last["role"],
+        "content": [{
+            "type": "text",
+            "text": last["content"],
+            "cache_control": {"type": "ephemeral"}
+        }]
+    }
+    return messages[:-1] + [tagged]
+
+async def get_safe_response(client: anthropic.AsyncAnthropic, messages: List[Dict], max_tokens: int, temperature: float, system: str, placeholder, cache_history: bool = True) -> tuple[Optional[str], Optional[Dict], Optional[str]]:
     try:
-        response = client.messages.create(
+        response_text = ""
+        last_redraw = time.monotonic()
+        async with client.messages.stream(
             model=CLAUDE_MODEL,
             max_tokens=max_tokens,
             temperature=temperature,
-            messages=messages
-        )
-        
-        if not response.content or not response.content[0].text:
-            return None, None, "Received empty response from Claude"
+            system=system,
+            messages=with_cache_breakpoint(messages) if cache_history else messages,
+            timeout=STREAM_STALL_TIMEOUT
+        ) as stream:
+            text_stream = stream.text_stream.__aiter__()
+            while True:
+                try:
+                    text = await asyncio.wait_for(text_stream.__anext__(), STREAM_STALL_TIMEOUT)
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    return None, None, "Claude stopped responding. Please try again."
+                response_text += text
+                now = time.monotonic()
+                if now - last_redraw >= STREAM_REDRAW_INTERVAL:
+                    placeholder.markdown(response_text)
+                    last_redraw = now
+            
+            if not response_text:
+                return None, None, "Received empty response from Claude"
+            placeholder.markdown(response_text)
             
+            usage = (await stream.get_final_message()).usage
+        
         usage_stats = {
-            'input_tokens': response.usage.input_tokens,
-            'output_tokens': response.usage.output_tokens
+            'input_tokens': usage.input_tokens,
+            'output_tokens': usage.output_tokens,
+            'cache_creation_input_tokens': usage.cache_creation_input_tokens or 0,
+            'cache_read_input_tokens': usage.cache_read_input_tokens or 0
         }
         
-        return response.content[0].text, usage_stats, None
+        return response_text, usage_stats, None
         
     except Exception as e:
         return None, None, handle_api_error(e)
 
-def export_conversation(messages: List[Dict], format: str = 'markdown') -> str:
+def export_conversation(messages: List[Dict], writer: TextIO, format: str = 'markdown', export_time: Optional[str] = None) -> None:
+    write = writer.write
     if format == 'markdown':
-        output = "# Chatbot Development Learning Session\n\n"
+        write("# Chatbot Development Learning Session\n\n")
         for msg in messages:
             role = msg['role'].capitalize()
             content = msg['content'].replace('```', '~~~')
-            output += f"## {role}\n\n{content}\n\n"
+            write(f"## {role}\n\n{content}\n\n")
             if 'cost' in msg:
-                output += f"*Cost: ${msg['cost']:.4f}*\n\n"
+                write(f"*Cost: ${msg['cost']:.4f}*\n\n")
                 
     elif format == 'json':
         export_data = {
             'conversation': messages,
-            'total_cost': st.session_state.total_cost,
-            'export_time': time.strftime('%Y-%m-%d %H:%M:%S')
+            'total_cost': total_cost(),
+            'export_time': export_time or time.strftime('%Y-%m-%d %H:%M:%S')
         }
-        output = json.dumps(export_data, indent=2)
+        write(orjson.dumps(export_data, option=orjson.OPT_INDENT_2).decode())
         
     else:  # plain text
-        output = "=== Chatbot Development Learning Session ===\n\n"
+        write("=== Chatbot Development Learning Session ===\n\n")
         for msg in messages:
             role = msg['role'].upper()
             content = msg['content']
-            output += f"[{role}]\n{content}\n\n"
+            write(f"[{role}]\n{content}\n\n")
             if 'cost' in msg:
-                output += f"Cost: ${msg['cost']:.4f}\n\n"
-        output += f"\nTotal Session Cost: ${st.session_state.total_cost:.4f}"
-    
-    return output
+                write(f"Cost: ${msg['cost']:.4f}\n\n")
+        write(f"\nTotal Session Cost: ${total_cost():.4f}")
+
+def render_text(text: str):
+    if MARKDOWN_PATTERN.search(text):
+        st.markdown(text)
+    else:
+        st.text(text)
+
+def render_history():
+    for message in st.session_state.messages:
+        with st.chat_message(message["role"]):
+            render_text(message["content"])
 
 def main():
     st.title("🤖 Interactive Chatbot Builder")
+    load_conversation()
     
     with st.sidebar:
         st.header("Control Panel")
@@ -142,7 +319,7 @@ def main():
         )
         
         st.subheader("Cost Tracking")
-        st.write(f"Current Session Cost: ${st.session_state.total_cost:.4f}")
+        st.write(f"Current Session Cost: ${total_cost():.4f}")
         
         st.subheader("Export Conversation")
         export_format = st.selectbox(
@@ -155,14 +332,19 @@ def main():
         
         if st.session_state.messages:
             if st.button("Export Conversation"):
-                exported_content = export_conversation(st.session_state.messages, export_format)
-                timestamp = time.strftime('%Y%m%d_%H%M%S')
+                now = time.localtime()
+                buf = io.StringIO()
+                export_conversation(
+                    st.session_state.messages, buf, export_format,
+                    export_time=time.strftime('%Y-%m-%d %H:%M:%S', now)
+                )
+                timestamp = time.strftime('%Y%m%d_%H%M%S', now)
                 file_extension = 'md' if export_format == 'markdown' else export_format
                 filename = f"chatbot_session_{timestamp}.{file_extension}"
                 
                 st.download_button(
                     label="Download Export",
-                    data=exported_content,
+                    data=buf.getvalue(),
                     file_name=filename,
                     mime="text/plain"
                 )
@@ -171,28 +353,27 @@ def main():
         st.warning("Please enter your API key in the sidebar to begin.")
         return
 
-    client = anthropic.Client(api_key=api_key)
+    session_client = get_session_client(api_key)
 
-    for message in st.session_state.messages:
-        with st.chat_message(message["role"]):
-            st.write(message["content"])
+    render_history()
 
     if prompt := st.chat_input("What would you like to learn about chatbot development?"):
-        st.session_state.messages.append({"role": "user", "content": prompt})
         with st.chat_message("user"):
-            st.write(prompt)
+            render_text(prompt)
 
-        messages = []
-        if len(st.session_state.messages) == 1:
-            messages.append({"role": "system", "content": INITIAL_SYSTEM_MESSAGE})
-        
-        for msg in st.session_state.messages:
-            role = "assistant" if msg["role"] == "assistant" else "user"
-            messages.append({"role": role, "content": msg["content"]})
+        request_messages = st.session_state.api_messages + [{"role": "user", "content": prompt}]
+        messages = select_relevant_history(
+            request_messages, st.session_state.term_vectors + [term_vector(prompt)]
+        )
+        cache_history = len(messages) == len(request_messages)
 
         with st.chat_message("assistant"):
-            response_text, usage_stats, error = get_safe_response(
-                client, messages, max_tokens, temperature
+            placeholder = st.empty()
+            response_text, usage_stats, error = session_client.run(
+                get_safe_response(
+                    session_client.client, messages, max_tokens, temperature, INITIAL_SYSTEM_MESSAGE, placeholder,
+                    cache_history
+                )
             )
             
             if error:
@@ -200,25 +381,20 @@ def main():
                 return
                 
             if response_text and usage_stats:
-                message_cost = calculate_cost(
+                message_cost_micro = calculate_cost_micro(
                     usage_stats['input_tokens'],
-                    usage_stats['output_tokens']
+                    usage_stats['output_tokens'],
+                    usage_stats['cache_creation_input_tokens'],
+                    usage_stats['cache_read_input_tokens']
                 )
-                st.session_state.total_cost += message_cost
                 
-                st.write(response_text)
+                message_cost = append_exchange(prompt, response_text, message_cost_micro)["cost"]
                 
-                st.session_state.messages.append({
-                    "role": "assistant",
-                    "content": response_text,
-                    "cost": message_cost
-                })
-                
-                st.caption(
-                    f"Tokens used - Input: {usage_stats['input_tokens']}, "
-                    f"Output: {usage_stats['output_tokens']}, "
-                    f"Cost: ${message_cost:.4f}"
-                )
+                st.caption(USAGE_CAPTION % (
+                    total_input_tokens(usage_stats),
+                    usage_stats['output_tokens'],
+                    message_cost
+                ))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
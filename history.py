@@ -0,0 +1,72 @@
+import heapq
+import math
+import re
+from collections import Counter
+from typing import Dict, List
+
+HISTORY_TOP_K_EXCHANGES = 4
+HISTORY_RECENT_EXCHANGES = 2
+WORD_PATTERN = re.compile(r'\w+')
+STOPWORDS = frozenset("""
+a about above after again all also am an and any are as at be because been before being
+below between both but by can could did do does doing down during each few for from
+further had has have having he her here hers him his how i if in into is it its itself
+just me more most my myself no nor not now of off on once only or other our ours out over
+own same she should so some such than that the their theirs them then there these they
+this those through to too under until up very was we were what when where which while who
+whom why will with would you your yours
+""".split())
+
+def term_vector(text: str) -> Counter:
+    return Counter(
+        word for word in WORD_PATTERN.findall(text.lower()) if word not in STOPWORDS
+    )
+
+def weighted(vector: Counter, idf: Dict[str, float], default_idf: float) -> Dict[str, float]:
+    return {term: count * idf.get(term, default_idf) for term, count in vector.items()}
+
+def cosine_similarity(a: Dict[str, float], b: Dict[str, float]) -> float:
+    if not a or not b:
+        return 0.0
+    dot = sum(weight * b[term] for term, weight in a.items() if term in b)
+    norm = math.sqrt(sum(w * w for w in a.values())) * math.sqrt(sum(w * w for w in b.values()))
+    return dot / norm
+
+def group_exchanges(messages: List[Dict]) -> List[List[int]]:
+    exchanges = []
+    for i, msg in enumerate(messages):
+        if msg["role"] == "user" or not exchanges:
+            exchanges.append([i])
+        else:
+            exchanges[-1].append(i)
+    return exchanges
+
+def select_relevant_history(
+    messages: List[Dict],
+    vectors: List[Counter],
+    top_k: int = HISTORY_TOP_K_EXCHANGES,
+    recent_count: int = HISTORY_RECENT_EXCHANGES
+) -> List[Dict]:
+    exchanges = group_exchanges(messages[:-1])
+    if len(exchanges) <= top_k + recent_count:
+        return messages
+
+    older, recent = exchanges[:-recent_count], exchanges[-recent_count:]
+    exchange_vectors = [sum((vectors[i] for i in exchange), Counter()) for exchange in older]
+
+    document_frequency = Counter()
+    for vector in exchange_vectors:
+        document_frequency.update(vector.keys())
+    num_docs = len(older)
+    idf = {
+        term: math.log((num_docs + 1) / (count + 1)) + 1
+        for term, count in document_frequency.items()
+    }
+    default_idf = math.log(num_docs + 1) + 1
+
+    query = weighted(vectors[-1], idf, default_idf)
+    scores = [cosine_similarity(query, weighted(vector, idf, default_idf)) for vector in exchange_vectors]
+    best = heapq.nlargest(top_k, range(len(older)), key=scores.__getitem__)
+
+    kept = [i for j in sorted(best) for i in older[j]] + [i for exchange in recent for i in exchange]
+    return [messages[i] for i in kept] + messages[-1:]
@@ -0,0 +1,59 @@
+from history import group_exchanges, select_relevant_history, term_vector
+
+def exchange(question, answer):
+    return [{"role": "user", "content": question}, {"role": "assistant", "content": answer}]
+
+def select(messages, **kwargs):
+    return select_relevant_history(messages, [term_vector(m["content"]) for m in messages], **kwargs)
+
+def test_on_topic_exchange_beats_stopword_heavy_ones():
+    messages = exchange(
+        "Where should the chatbot store conversation memory?",
+        "Keep chatbot memory in a database keyed by session."
+    )
+    for topic in ["deploying", "styling", "hosting", "logging", "billing", "testing"]:
+        messages += exchange(
+            f"How do I get my app to do {topic} and how do I make it work for me?",
+            f"You can do {topic} in the settings if you want it to."
+        )
+    messages += exchange("Which font looks nice?", "Use a sans-serif font.")
+    messages += exchange("Thanks!", "You're welcome.")
+    messages.append({"role": "user", "content": "How do I add memory to my chatbot?"})
+
+    selected = select(messages, top_k=1)
+
+    assert selected[:2] == messages[:2]
+
+def test_last_two_exchanges_are_always_kept():
+    messages = []
+    for i in range(8):
+        messages += exchange(f"question about topic{i}", f"answer about topic{i}")
+    messages.append({"role": "user", "content": "tell me about topic0"})
+
+    selected = select(messages)
+
+    assert selected[-5:] == messages[-5:]
+    assert len(selected) == 2 * 6 + 1
+
+def test_failed_turn_keeps_answers_with_their_questions():
+    messages = [
+        {"role": "user", "content": "u0"},
+        {"role": "assistant", "content": "a0"},
+        {"role": "user", "content": "u1 failed"},
+        {"role": "user", "content": "u2"},
+        {"role": "assistant", "content": "a2"},
+    ]
+
+    assert group_exchanges(messages) == [[0, 1], [2], [3, 4]]
+
+    history = messages[:]
+    for i in range(3, 9):
+        history += exchange(f"u{i}", f"a{i}")
+    history.append({"role": "user", "content": "u2"})
+
+    selected = select(history)
+
+    for i, msg in enumerate(selected[:-1]):
+        if msg["role"] == "assistant":
+            assert selected[i - 1]["content"].split()[0] == "u" + msg["content"][1:]
+    assert selected[-5]["role"] == "user"